@@ -0,0 +1,50 @@
+"""
+Please refer to top-level LICENSE file for copyright information
+"""
+
+import os
+import boto3
+from botocore.config import Config
+
+# botocore's own default pool size.
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# Fail fast on stalled endpoints and let the SDK retry, backing off with
+# jitter and client side rate limiting when AWS starts throttling.
+CONNECT_TIMEOUT_SEC = 2
+READ_TIMEOUT_SEC = 10
+RETRIES = {'max_attempts': 8, 'mode': 'adaptive'}
+
+
+def create_session(aws_key=None, aws_secret_key=None, region=None):
+    """
+    The create_session function will build a boto3 session that can be
+    shared by every AWS client used during a run.
+    :param aws_key: AWS access key
+    :param aws_secret_key: AWS secret key
+    :param region: default region for the clients created from the session
+    :return: boto3 Session object
+    """
+    if aws_key and aws_secret_key:
+        # With explicit credentials the instance metadata service has nothing
+        # to offer, and off EC2 every lookup of it stalls until it times out.
+        os.environ.setdefault('AWS_EC2_METADATA_DISABLED', 'true')
+    return boto3.session.Session(aws_access_key_id=aws_key,
+                                 aws_secret_access_key=aws_secret_key,
+                                 region_name=region)
+
+
+def client_config(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    """
+    The client_config function will build the botocore configuration used
+    for all clients, sizing the HTTPS connection pool so that concurrent
+    calls reuse connections instead of opening new ones, and bounding how
+    long a single call may stall.
+    :param max_pool_connections: number of pooled connections per client
+    :return: botocore Config object
+    """
+    return Config(max_pool_connections=max(DEFAULT_MAX_POOL_CONNECTIONS,
+                                           max_pool_connections),
+                  connect_timeout=CONNECT_TIMEOUT_SEC,
+                  read_timeout=READ_TIMEOUT_SEC,
+                  retries=RETRIES)
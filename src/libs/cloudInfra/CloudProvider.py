@@ -4,12 +4,87 @@ Please refer to top-level LICENSE file for copyright information
 
 import time
 import os
+import re
+import collections
 import logging
-import boto
-import boto.ec2
-from fabric.api import (env, run, settings)
+import threading
+import paramiko
+from botocore.exceptions import (BotoCoreError, ClientError, WaiterError)
+from src.libs.cloudInfra import AwsSession
+from src.libs.utils import backoff_delays
 
 log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Stock Ubuntu image, see README for baking an image with everything the
+# tests need already installed.
+DEFAULT_EC2_INSTANCE_IMAGE = 'ami-2afbde4a'
+
+# boto3 waiters used to track the instances through each state.
+_STATE_WAITERS = {'running': 'instance_running',
+                  'terminated': 'instance_terminated'}
+_WAITER_DELAY_SEC = 15
+_STATE_POLL_INITIAL_SEC = 2
+_STATE_POLL_MAX_SEC = 15
+
+# Command output is read off the SSH channel in chunks, of which only the
+# tail is logged when a command fails.
+_RECV_CHUNK_SIZE = 32768
+_ERROR_OUTPUT_TAIL_SIZE = 65536
+
+# Cap on the TCP connect, SSH banner and authentication of each new SSH
+# session, in seconds.
+_SSH_CONNECT_TIMEOUT_SEC = 10
+
+# Timeout of each liveness probe of a booting instance.
+_GOS_PROBE_TIMEOUT_SEC = 5
+
+# Service Quotas code for the vCPU limit on running On-Demand standard
+# (A, C, D, H, I, M, R, T, Z) instances.
+_STANDARD_VCPU_QUOTA_CODE = 'L-1216C47A'
+_STANDARD_FAMILY_RE = re.compile(r'^[acdhimrtz][a-z]*\d')
+_NON_STANDARD_FAMILY_RE = re.compile(r'^(inf|hpc|dl|trn)\d')
+
+# Process wide cache of describe lookups that don't change during a run,
+# (region, kind, name) -> (expiry time, value).  Lookups hold the lock so
+# that providers connecting at the same time only make the call once.
+_describe_cache = {}
+_describe_lock = threading.RLock()
+_DESCRIBE_CACHE_TTL_SEC = 900
+
+
+def _cached_describe(region, kind, name, fetch_fn,
+                     ttl_sec=_DESCRIBE_CACHE_TTL_SEC):
+    """
+    The _cached_describe function will return the cached result of a
+    describe lookup, only calling fetch_fn when there is no live entry.
+    Errors raised by fetch_fn are not cached.
+    :param region: region the lookup was made in
+    :param kind: kind of resource being looked up
+    :param name: name of the resource being looked up
+    :param fetch_fn: function performing the actual lookup
+    :param ttl_sec: number of seconds the result stays valid
+    :return: result of the lookup
+    """
+    with _describe_lock:
+        entry = _describe_cache.get((region, kind, name))
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        value = fetch_fn()
+        _store_describe(region, kind, name, value, ttl_sec)
+        return value
+
+
+def _is_standard_instance_type(instance_type):
+    return bool(_STANDARD_FAMILY_RE.match(instance_type) and
+                not _NON_STANDARD_FAMILY_RE.match(instance_type))
+
+
+def _store_describe(region, kind, name, value,
+                    ttl_sec=_DESCRIBE_CACHE_TTL_SEC):
+    with _describe_lock:
+        _describe_cache[(region, kind, name)] = (time.time() + ttl_sec,
+                                                 value)
 
 
 class CloudProvider(object):
@@ -41,6 +116,17 @@ class CloudProvider(object):
         """
         raise RuntimeError("Implemented in child class")
 
+    def create_image(self, virtual_instance, image_name, timeout_sec=900):
+        """
+        The create_image method will save the state of the given instance
+        as a new image, which can then be used to create new instances.
+        :param virtual_instance: virtual instance to create the image from
+        :param image_name: name of the new image
+        :param timeout_sec:
+        :return: id of the new image
+        """
+        raise RuntimeError("Implemented in child class")
+
 
 class CloudProviderAWS(CloudProvider):
     """
@@ -51,7 +137,7 @@ class CloudProviderAWS(CloudProvider):
     # pylint: disable=too-many-instance-attributes
     # Lots of little pieces of information here, easier to track.
     def __init__(self,
-                 ec2_instance_image='ami-2afbde4a',
+                 ec2_instance_image=DEFAULT_EC2_INSTANCE_IMAGE,
                  ec2_instance_user_name='ubuntu',
                  ec2_instance_type='t2.micro',
                  ec2_security_group='botoTestSecGrp',
@@ -60,7 +146,9 @@ class CloudProviderAWS(CloudProvider):
                  ec2_aws_key=None,
                  ec2_aws_secret_key=None,
                  ec2_key_pair_name=None,
-                 ec2_key_pair_file_path=None):
+                 ec2_key_pair_file_path=None,
+                 session=None,
+                 max_pool_connections=AwsSession.DEFAULT_MAX_POOL_CONNECTIONS):
         self._ec2_instance_image = ec2_instance_image
         self._ec2_instance_user_name = ec2_instance_user_name
         self._ec2_instance_type = ec2_instance_type
@@ -69,112 +157,226 @@ class CloudProviderAWS(CloudProvider):
         self._ec2_key_pair_name = ec2_key_pair_name
 
         self._ec2 = None
-        self._ec2_reservation = None
+        self._ec2_instance_ids = []
         self._ec2_instances = None
+        self._virtual_instances = []
         self._ec2_key_file = ec2_key_pair_file_path
         self._ec2_region = ec2_region
         self._ec2_aws_key = ec2_aws_key
         self._ec2_aws_secret_key = ec2_aws_secret_key
+        self._session = session
+        self._max_pool_connections = max_pool_connections
 
     def connect(self):
-        self._ec2 = boto.ec2.connect_to_region(
-                        self._ec2_region,
-                        aws_access_key_id=self._ec2_aws_key,
-                        aws_secret_access_key=self._ec2_aws_secret_key)
-        if self._ec2 is None:
-            logging.error('Could not connect to ec2 region: %s',
-                          self._ec2_region)
-            raise Exception
+        if self._session is None:
+            self._session = AwsSession.create_session(
+                aws_key=self._ec2_aws_key,
+                aws_secret_key=self._ec2_aws_secret_key,
+                region=self._ec2_region)
+        self._ec2 = self._session.client(
+                        'ec2',
+                        region_name=self._ec2_region,
+                        config=AwsSession.client_config(
+                            self._max_pool_connections))
 
-        if not self._ec2.get_key_pair(self._ec2_key_pair_name):
+        try:
+            _cached_describe(
+                self._ec2_region, 'key_pair', self._ec2_key_pair_name,
+                lambda: self._ec2.describe_key_pairs(
+                    KeyNames=[self._ec2_key_pair_name])['KeyPairs'])
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'InvalidKeyPair.NotFound':
+                raise
             log.error("Could not find keypair: %s", self._ec2_key_pair_name)
             raise Exception('Keypair not found on AWS')
         if not os.path.exists(self._ec2_key_file):
             log.error('Could not find keypair file: %s', self._ec2_key_file)
             raise Exception('Keypair file not found')
 
-        # Setup security group if necessary
+        # Setup security group if necessary, holding the lock across the
+        # create so that only one of several providers connecting at once
+        # creates the group.
+        with _describe_lock:
+            try:
+                sec_groups = _cached_describe(
+                    self._ec2_region, 'security_group',
+                    self._ec2_security_group,
+                    lambda: self._ec2.describe_security_groups(
+                        GroupNames=[self._ec2_security_group])
+                    ['SecurityGroups'])
+                if len(sec_groups) != 1:
+                    logging.error('Expected 1 group, found more then one:%s',
+                                  str(sec_groups))
+                    raise Exception
+            except ClientError as err:
+                if err.response['Error']['Code'] != 'InvalidGroup.NotFound':
+                    raise
+
+                # Create security group
+                log.info('Security group not found, attempting to create')
+                group_id = self._ec2.create_security_group(
+                    GroupName=self._ec2_security_group,
+                    Description=self._ec2_security_group_desc)['GroupId']
+                # Open up port 22 for ssh access
+                self._ec2.authorize_security_group_ingress(
+                    GroupName=self._ec2_security_group,
+                    IpProtocol='tcp',
+                    FromPort=22,
+                    ToPort=22,
+                    CidrIp='0.0.0.0/0')
+                _store_describe(self._ec2_region, 'security_group',
+                                self._ec2_security_group,
+                                [{'GroupName': self._ec2_security_group,
+                                  'GroupId': group_id}])
+                log.info('Done creating security group: %s',
+                         self._ec2_security_group)
+
+    def _get_vcpus(self, instance_type):
+        return _cached_describe(
+            self._ec2_region, 'instance_type', instance_type,
+            lambda: self._ec2.describe_instance_types(
+                InstanceTypes=[instance_type])['InstanceTypes'][0]
+            ['VCpuInfo']['DefaultVCpus'])
+
+    def _check_instance_quota(self, count):
+        """
+        The _check_instance_quota method will make sure that starting count
+        more instances stays within the account's vCPU quota, so that an
+        over quota request fails right away.
+        :param count: number of instances about to be started
+        :return:
+        """
+        if not _is_standard_instance_type(self._ec2_instance_type):
+            return
+        quotas = self._session.client('service-quotas',
+                                      region_name=self._ec2_region,
+                                      config=AwsSession.client_config())
+        # The check is advisory, credentials that can't read everything it
+        # needs shouldn't stop the run.
         try:
-            sec_groups = self._ec2.get_all_security_groups(
-                [self._ec2_security_group])
-            if len(sec_groups) != 1:
-                logging.error('Expected 1 group, found more then one:%s',
-                              str(sec_groups))
-                raise Exception
-            sec_groups.pop()
-        except boto.exception.EC2ResponseError:
-            # Honestly, we should parse the xml data here in the exception
-            # to see that this was actually due to the security group not being
-            # found.
-
-            # Create security group
-            log.info('Security group not found, attempting to create')
-            sec_group = \
-                self._ec2.create_security_group(self._ec2_security_group,
-                                                self._ec2_security_group_desc)
-            # Open up port 22 for ssh access
-            sec_group.authorize(ip_protocol='tcp',
-                                from_port=22,
-                                to_port=22,
-                                cidr_ip='0.0.0.0/0')
-            log.info('Done creating security group: %s', sec_group.name)
+            limit = quotas.get_service_quota(
+                ServiceCode='ec2',
+                QuotaCode=_STANDARD_VCPU_QUOTA_CODE)['Quota']['Value']
+
+            in_use = 0
+            paginator = self._ec2.get_paginator('describe_instances')
+            for page in paginator.paginate(
+                    Filters=[{'Name': 'instance-state-name',
+                              'Values': ['pending', 'running']}]):
+                for res in page['Reservations']:
+                    for instance in res['Instances']:
+                        if instance.get('InstanceLifecycle') == 'spot' or \
+                                not _is_standard_instance_type(
+                                    instance['InstanceType']):
+                            continue
+                        in_use += self._get_vcpus(instance['InstanceType'])
+
+            needed = count * self._get_vcpus(self._ec2_instance_type)
+        except (ClientError, BotoCoreError):
+            log.warning('Could not work out the vCPU quota, skipping check',
+                        exc_info=True)
+            return
+
+        if in_use + needed > limit:
+            log.error('Need %d vCPUs but only %d of the %d vCPU quota are'
+                      ' free', needed, limit - in_use, limit)
+            raise Exception('Instance quota exceeded')
 
     def create_instances(self, count, timeout_sec=300):
-        self._ec2_reservation = \
-            self._ec2.run_instances(self._ec2_instance_image,
-                                    instance_type=self._ec2_instance_type,
-                                    security_groups=[self._ec2_security_group],
-                                    key_name=self._ec2_key_pair_name,
-                                    min_count=count,
-                                    max_count=count)
+        self._check_instance_quota(count)
+        reservation = \
+            self._ec2.run_instances(ImageId=self._ec2_instance_image,
+                                    InstanceType=self._ec2_instance_type,
+                                    SecurityGroups=[self._ec2_security_group],
+                                    KeyName=self._ec2_key_pair_name,
+                                    MinCount=count,
+                                    MaxCount=count)
 
-        self._ec2_instances = self._ec2_reservation.instances
+        self._ec2_instance_ids = [instance['InstanceId']
+                                  for instance in reservation['Instances']]
 
         # Wait for the instances to fully init. run local command and
         # get output
-        if not self._wait_for_instance_state(300, 'running'):
+        if not self._wait_for_instance_state(self._ec2_instance_ids,
+                                             timeout_sec, 'running'):
             self.destroy_all_instances()
             raise Exception
         log.info('Instances have successfully started')
-        virtual_instances = []
-        for instance in self._ec2_instances:
-            virtual_instances.append(
-                VirtualInstanceAWS(instance=instance,
-                                   key_file=self._ec2_key_file,
-                                   login_name=self._ec2_instance_user_name))
-        return virtual_instances
+
+        # Public addresses are only assigned once the instances are running,
+        # so fetch the instance descriptions again.
+        reservations = self._ec2.describe_instances(
+            InstanceIds=self._ec2_instance_ids)['Reservations']
+        self._ec2_instances = [instance for res in reservations
+                               for instance in res['Instances']]
+        self._virtual_instances = [
+            VirtualInstanceAWS(instance=instance,
+                               key_file=self._ec2_key_file,
+                               login_name=self._ec2_instance_user_name)
+            for instance in self._ec2_instances]
+        return list(self._virtual_instances)
 
     def destroy_all_instances(self):
-        instance_ids = []
-        for instance in self._ec2_instances:
-            instance_ids.append(instance.id)
-        self._ec2.terminate_instances(instance_ids=instance_ids)
-        if not self._wait_for_instance_state(300, 'terminated'):
+        # Drop the SSH sessions before their hosts go away.
+        for virtual_instance in self._virtual_instances:
+            virtual_instance.close()
+        self._virtual_instances = []
+        instance_ids = list(self._ec2_instance_ids)
+        if not instance_ids:
+            return
+        self._ec2.terminate_instances(InstanceIds=instance_ids)
+        if not self._wait_for_instance_state(instance_ids, 300,
+                                             'terminated'):
             raise Exception
+        self._ec2_instance_ids = []
+
+    def create_image(self, virtual_instance, image_name, timeout_sec=900):
+        image_id = self._ec2.create_image(
+            InstanceId=virtual_instance.get_instance_id(),
+            Name=image_name)['ImageId']
+        log.info('Waiting for image %s to become available', image_id)
+        try:
+            self._ec2.get_waiter('image_available').wait(
+                ImageIds=[image_id],
+                WaiterConfig={
+                    'Delay': _WAITER_DELAY_SEC,
+                    'MaxAttempts': max(1, timeout_sec // _WAITER_DELAY_SEC)})
+        except WaiterError:
+            log.exception('Timed out waiting for image: %s', image_id)
+            raise Exception('Image creation failed')
+        log.info('Image %s is now available', image_id)
+        return image_id
 
-    def _wait_for_instance_state(self, timeout_sec, state):
+    def _wait_for_instance_state(self, instance_ids, timeout_sec, state):
+        # The waiters check every instance with a single DescribeInstances
+        # call per attempt, and retry while AWS doesn't yet recognize its
+        # own freshly launched instances.  Run them one attempt at a time
+        # so that the polling interval can back off from a short start.
+        waiter = self._ec2.get_waiter(_STATE_WAITERS[state])
         timeout = time.time() + timeout_sec
-        all_match_state = False
-        while time.time() < timeout and all_match_state is False:
-            all_match_state = True
-            for instance in self._ec2_reservation.instances:
-                try:
-                    instance.update()
-                    log.info('Found instance with state: %s', instance.state)
-                    if instance.state != state:
-                        all_match_state = False
-                except Exception:
-                    # Sometimes AWS doesn't recognize it's own instances for a
-                    # bit, ignore, and keep trying.
-                    all_match_state = False
-
-            log.info('Waiting for instances to match state: %s', state)
-            if all_match_state is False:
-                time.sleep(30)
-        if time.time() >= timeout:
-            log.error('Timed out waiting for instances to match state: %s',
-                      state)
-            return False
+        delays = backoff_delays(_STATE_POLL_INITIAL_SEC, _STATE_POLL_MAX_SEC)
+        log.info('Waiting for instances to match state: %s', state)
+        while True:
+            try:
+                waiter.wait(InstanceIds=instance_ids,
+                            WaiterConfig={'MaxAttempts': 1})
+                break
+            except WaiterError as err:
+                # Keep polling while the state isn't reached yet, or while
+                # some of the ids aren't known to DescribeInstances yet.
+                error_code = (err.last_response or {}).get(
+                    'Error', {}).get('Code')
+                if not (str(err.kwargs.get('reason')).startswith(
+                        'Max attempts exceeded') or
+                        error_code == 'InvalidInstanceID.NotFound'):
+                    log.error('Instances failed to reach state %s: %s',
+                              state, err)
+                    return False
+            if time.time() >= timeout:
+                log.error('Timed out waiting for instances to match state: %s',
+                          state)
+                return False
+            time.sleep(min(next(delays), max(0, timeout - time.time())))
         log.info('All instances now match state: %s ', state)
         return True
 
@@ -198,19 +400,56 @@ class VirtualInstance(object):
 
     def wait_for_gos_to_respond(self, timeout_sec=300):
         timeout = time.time() + timeout_sec
+        delays = backoff_delays(1, 10)
         gos_responds = False
         while timeout > time.time() and gos_responds is False:
             try:
-                self.run_command_on_gos('echo hello', 120)
+                # Only needs the connection to come up, a longer timeout
+                # would just hide a hung instance.  The timeout bounds the
+                # SSH connect as well as the command.
+                self.run_command_on_gos('echo hello', _GOS_PROBE_TIMEOUT_SEC)
                 gos_responds = True
-            except Exception:
-                log.exception("Got exception while waiting for GOS to respond")
-                log.info('Waiting for GOS to respond')
-                time.sleep(10)
+            except Exception as err:
+                # Expected while the instance boots, keep the traceback
+                # for debugging only.
+                log.info('Waiting for GOS to respond: %s', err)
+                log.debug('GOS not responding yet', exc_info=True)
+                time.sleep(next(delays))
 
-    def run_command_on_gos(self, command, timeout_sec=120):
+    def run_command_on_gos(self, command, timeout_sec=120,
+                           capture_output=True):
         raise RuntimeError("Implemented in child class")
 
+    def run_commands_on_gos(self, commands, timeout_sec=120):
+        """
+        The run_commands_on_gos method will run several commands one after
+        the other over the same connection to the GOS, stopping at the
+        first one that fails.
+        :param commands: list of commands to run
+        :param timeout_sec: timeout for each of the commands
+        :return: list with the output of each command
+        """
+        return [self.run_command_on_gos(command, timeout_sec)
+                for command in commands]
+
+    def write_file_on_gos(self, path, content, mode=0o600):
+        """
+        The write_file_on_gos method will write content to a file on the
+        GOS without it going through a command line, so that it is neither
+        logged nor visible in the process list.
+        :param path: path of the file, relative to the home directory
+        :param content: content of the file
+        :param mode: permissions of the file
+        :return:
+        """
+        raise RuntimeError("Implemented in child class")
+
+    def close(self):
+        """
+        The close method will release any connection held to the GOS.
+        :return:
+        """
+
 
 class VirtualInstanceAWS(VirtualInstance):
     """
@@ -224,25 +463,94 @@ class VirtualInstanceAWS(VirtualInstance):
         if not (login_name and key_file):
             log.error("Need login name + keyfile for AWS connections")
             raise RuntimeError("Missing creds for AWS")
-        env.use_ssh_config = False
-        env.user = self._login_name
-        env.key_filename = self._key_file
-        env.password = ""
-        env.disable_known_hosts = True  # AWS instances are transitory
-        env.warn_only = True
+        # The public address doesn't change while the instance is running.
+        self._instance_ip = instance.get('PublicIpAddress')
+        self._ssh = None
 
     def get_instance_id(self):
-        return self._instance.id
+        return self._instance['InstanceId']
 
     def get_instance_ip(self):
-        return self._instance.ip_address
-
-    def run_command_on_gos(self, command, timeout_sec=120):
-        log.info("Running command: %s", command)
-        with settings(host_string=self.get_instance_ip()):
-            result = run(command, timeout=timeout_sec)
-            if result.return_code != 0:
-                log.error("Error stdout:%s", result.stdout)
-                log.error("Error stderr:%s", result.stderr)
-                raise RuntimeError('Error found while running cmd')
-            return result.stdout
+        return self._instance_ip
+
+    def _get_ssh_client(self, timeout_sec=_SSH_CONNECT_TIMEOUT_SEC):
+        # Keep one SSH session open per instance so that consecutive commands
+        # don't each pay for the TCP + SSH handshake.
+        if self._ssh is not None:
+            transport = self._ssh.get_transport()
+            if transport is not None and transport.is_active():
+                return self._ssh
+            self.close()
+        ssh = paramiko.SSHClient()
+        # AWS instances are transitory
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(self.get_instance_ip(),
+                    username=self._login_name,
+                    key_filename=self._key_file,
+                    look_for_keys=False,
+                    allow_agent=False,
+                    timeout=timeout_sec,
+                    banner_timeout=timeout_sec,
+                    auth_timeout=timeout_sec)
+        self._ssh = ssh
+        return self._ssh
+
+    def run_command_on_gos(self, command, timeout_sec=120,
+                           capture_output=True):
+        if log.isEnabledFor(logging.INFO):
+            log.info("Running command: %s", command)
+        # Only keep the whole output when the caller wants it back or it is
+        # going to be logged, otherwise just enough of its tail to explain
+        # a failure.
+        keep_all = capture_output or log.isEnabledFor(logging.DEBUG)
+        chunks = collections.deque()
+        kept = 0
+        # Bound the connect as well, it is what hangs while an instance's
+        # network is still coming up.
+        ssh = self._get_ssh_client(min(timeout_sec, _SSH_CONNECT_TIMEOUT_SEC))
+        channel = ssh.get_transport().open_session()
+        try:
+            channel.settimeout(timeout_sec)
+            # Like a terminal, keep stderr (where `time` reports) in the
+            # returned output.
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            while True:
+                data = channel.recv(_RECV_CHUNK_SIZE)
+                if not data:
+                    break
+                chunks.append(data)
+                kept += len(data)
+                while not keep_all and kept - len(chunks[0]) >= \
+                        _ERROR_OUTPUT_TAIL_SIZE:
+                    kept -= len(chunks.popleft())
+            return_code = channel.recv_exit_status()
+        finally:
+            channel.close()
+        output = b''.join(chunks).decode('utf-8', 'replace')
+        if return_code == -1:
+            # The channel closed without an exit status, the connection
+            # dropped rather than the command failing.
+            log.error("Connection lost while running cmd, output:%s",
+                      output[-_ERROR_OUTPUT_TAIL_SIZE:])
+            raise paramiko.SSHException('Connection lost while running cmd')
+        if return_code != 0:
+            log.error("Error output:%s", output[-_ERROR_OUTPUT_TAIL_SIZE:])
+            raise RuntimeError('Error found while running cmd')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Output:%s", output)
+        return output if capture_output else None
+
+    def write_file_on_gos(self, path, content, mode=0o600):
+        sftp = self._get_ssh_client().open_sftp()
+        try:
+            with sftp.open(path, 'w') as remote_file:
+                remote_file.chmod(mode)
+                remote_file.write(content)
+        finally:
+            sftp.close()
+
+    def close(self):
+        if self._ssh is not None:
+            self._ssh.close()
+            self._ssh = None
@@ -2,7 +2,28 @@
 Please refer to top-level LICENSE file for copyright information
 """
 
-from boto.s3.connection import S3Connection
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from src.libs.cloudInfra import AwsSession
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Number of DeleteObjects requests kept in flight while erasing a bucket,
+# and the most keys a single request may carry.
+_ERASE_WORKERS = 8
+_DELETE_BATCH_SIZE = 1000
+
+# How long a bucket_exists answer is reused for.
+_BUCKET_EXISTS_TTL_SEC = 300
+
+# Sign with SigV4 against the bucket's regional endpoint, so that presigned
+# urls of a new bucket outside us-east-1 aren't answered with a redirect.
+_S3_CONFIG = Config(signature_version='s3v4',
+                    s3={'addressing_style': 'virtual'})
 
 
 class VirtualStorage(object):
@@ -52,39 +73,126 @@ class VirtualStorage(object):
         """
         raise RuntimeError("Implemented in child class")
 
+    def object_exists(self, bucket_name, key):
+        """
+        The object_exists method is used to find if an object exists in a
+        bucket.
+        :param bucket_name: string containing the name of a bucket.
+        :param key: string containing the key of the object.
+        :return: True if the object exists, False otherwise.
+        """
+        raise RuntimeError("Implemented in child class")
+
+    def get_object_url(self, bucket_name, key, method='get', expires_sec=3600):
+        """
+        The get_object_url method will create a temporary URL that allows
+        downloading ('get') or uploading ('put') an object without needing
+        credentials for the storage system.
+        :param bucket_name: string containing the name of a bucket.
+        :param key: string containing the key of the object.
+        :param method: 'get' or 'put'
+        :param expires_sec: number of seconds the URL stays valid.
+        :return: string containing the URL.
+        """
+        raise RuntimeError("Implemented in child class")
+
 
 class VirtualStorageS3(VirtualStorage):
     """
     VirtualStorageS3 class encapsulates the virtual storage functionality
     specific to and AWS S3 object store.
     """
-    def __init__(self, aws_key=None, aws_secret_key=None,):
+    def __init__(self, aws_key=None, aws_secret_key=None, session=None,
+                 max_pool_connections=AwsSession.DEFAULT_MAX_POOL_CONNECTIONS):
         self._aws_key = aws_key
         self._aws_secret_key = aws_secret_key
+        self._session = session
+        self._max_pool_connections = max_pool_connections
 
         self._s3_store_connect = None
-        self._s3_bucket = None
+        # bucket name -> (expiry time, exists)
+        self._bucket_exists_cache = {}
 
     def connect(self):
-        self._s3_store_connect = S3Connection(self._aws_key,
-                                              self._aws_secret_key)
+        if self._session is None:
+            self._session = AwsSession.create_session(
+                aws_key=self._aws_key,
+                aws_secret_key=self._aws_secret_key)
+        self._s3_store_connect = self._session.client(
+            's3',
+            config=AwsSession.client_config(
+                self._max_pool_connections).merge(_S3_CONFIG))
 
     def bucket_exists(self, bucket_name):
-        if self._s3_store_connect.lookup(bucket_name) is not None:
-            return True
-        else:
-            return False
+        entry = self._bucket_exists_cache.get(bucket_name)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        try:
+            self._s3_store_connect.head_bucket(Bucket=bucket_name)
+            exists = True
+        except ClientError:
+            exists = False
+        self._set_bucket_exists(bucket_name, exists)
+        return exists
+
+    def _set_bucket_exists(self, bucket_name, exists):
+        self._bucket_exists_cache[bucket_name] = \
+            (time.time() + _BUCKET_EXISTS_TTL_SEC, exists)
 
     def create_bucket(self, bucket_name):
-        self._s3_store_connect.create_bucket(bucket_name)
-
-    def _get_bucket(self, bucket_name):
-        return self._s3_store_connect.get_bucket(bucket_name)
+        region = self._s3_store_connect.meta.region_name
+        if region in (None, 'us-east-1'):
+            self._s3_store_connect.create_bucket(Bucket=bucket_name)
+        else:
+            self._s3_store_connect.create_bucket(
+                Bucket=bucket_name,
+                CreateBucketConfiguration={'LocationConstraint': region})
+        self._set_bucket_exists(bucket_name, True)
 
     def delete_bucket(self, bucket_name):
-        self._s3_store_connect.delete_bucket(self._get_bucket(bucket_name))
+        self._s3_store_connect.delete_bucket(Bucket=bucket_name)
+        self._set_bucket_exists(bucket_name, False)
 
     def erase_bucket(self, bucket_name):
-        bucket = self._s3_store_connect.get_bucket(bucket_name)
-        for key in bucket.list():
-            key.delete()
+        # Each listing page is deleted with a single DeleteObjects request.
+        # The deletes run in the background so that the next page is listed
+        # while they're in flight.
+        paginator = self._s3_store_connect.get_paginator('list_objects_v2')
+        executor = ThreadPoolExecutor(max_workers=_ERASE_WORKERS)
+        try:
+            futures = []
+            for page in paginator.paginate(
+                    Bucket=bucket_name,
+                    PaginationConfig={'PageSize': _DELETE_BATCH_SIZE}):
+                keys = [{'Key': key['Key']}
+                        for key in page.get('Contents', [])]
+                if keys:
+                    futures.append(executor.submit(self._delete_keys,
+                                                   bucket_name, keys))
+            failed = [future for future in futures if not future.result()]
+        finally:
+            executor.shutdown(wait=True)
+        if failed:
+            raise RuntimeError('Failed to erase bucket: ' + bucket_name)
+
+    def _delete_keys(self, bucket_name, keys):
+        response = self._s3_store_connect.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': keys, 'Quiet': True})
+        for error in response.get('Errors', []):
+            log.error('Failed to delete key %s: %s',
+                      error['Key'], error['Message'])
+        return not response.get('Errors')
+
+    def object_exists(self, bucket_name, key):
+        try:
+            self._s3_store_connect.head_object(Bucket=bucket_name, Key=key)
+        except ClientError:
+            return False
+        return True
+
+    def get_object_url(self, bucket_name, key, method='get', expires_sec=3600):
+        return self._s3_store_connect.generate_presigned_url(
+            method + '_object',
+            Params={'Bucket': bucket_name, 'Key': key},
+            ExpiresIn=expires_sec)
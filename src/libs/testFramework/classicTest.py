@@ -4,9 +4,15 @@ Please refer to top-level LICENSE file for copyright information
 
 import logging
 import threading
-from src.libs.utils import ThreadWithError
+from concurrent.futures import (ThreadPoolExecutor, TimeoutError,
+                                as_completed)
 
 log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Upper bound on concurrently running tests, keeps the number of in-flight
+# AWS/SSH calls below the point where they start getting throttled.
+MAX_WORKERS = 32
 
 
 class TestInstance(object):
@@ -79,45 +85,75 @@ class TestInstance(object):
 
 
 class PerformParallelOperations(object):
-    def __init__(self, test_instances=None):
+    """
+    PerformParallelOperations class runs each test phase on all the tests
+    concurrently, using at most max_workers threads.  An executor owned by
+    the caller (sized to max_workers) can be passed in, otherwise one is
+    made and kept for all the phases until close() is called.
+    """
+    def __init__(self, test_instances=None, max_workers=MAX_WORKERS,
+                 executor=None):
         self.tests = test_instances
         self.results = []
         if not self.tests or len(self.tests) == 0:
             raise Exception("No tests specified")
-
-    def _thread_run_and_gather(self, test, method, lock):
-        result = getattr(test, method)()
-        with lock:
-            self.results.append({method: result})
-
-    def _perform_ops(self, method=None, timeout_sec=900, lock=None, args=None):
-        thread_list = []
-        for test in self.tests:
-            t = ThreadWithError(target=self._thread_run_and_gather,
-                                args=[test,
-                                      method,
-                                      lock])
-            thread_list.append(t)
-            t.start()
-
-        for t in thread_list:
-            t.join(timeout_sec)
-            if t.is_alive():
-                raise RuntimeError('Timed out during threaded operation')
-            if t.has_error():
-                raise RuntimeError('Error during threaded operation')
+        self._max_workers = min(len(self.tests), max_workers)
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        self._executor = executor
+
+    @staticmethod
+    def _run_when_started(start, test, methods):
+        start.wait()
+        return dict((method, getattr(test, method)()) for method in methods)
+
+    def _perform_ops(self, methods=None, timeout_sec=900):
+        # The methods run one after the other on each test, without waiting
+        # for the other tests in between.  timeout_sec applies to each
+        # method of each test, which may have to queue behind others when
+        # there are more tests than workers.
+        waves = (len(self.tests) + self._max_workers - 1) // self._max_workers
+        # Hold the workers until every test is queued so that the phase
+        # starts on all of them at the same time.
+        start = threading.Event()
+        futures = dict((self._executor.submit(self._run_when_started, start,
+                                              test, methods), index)
+                       for index, test in enumerate(self.tests))
+        start.set()
+        # Each result goes in its test's slot, keeping the results in the
+        # same order as the tests whatever order they complete in.
+        phase_results = [None] * len(self.tests)
+        try:
+            for future in as_completed(
+                    futures, timeout=timeout_sec * waves * len(methods)):
+                phase_results[futures[future]] = future.result()
+        except TimeoutError:
+            raise RuntimeError('Timed out during threaded operation')
+        self.results.extend(phase_results)
+
+    def close(self):
+        """
+        The close method will release the worker threads, unless the
+        executor was passed in by the caller.
+        :return:
+        """
+        if self._owns_executor:
+            self._executor.shutdown(wait=False)
 
     def perform_all_operations(self):
-
-        for method in ['setup_environment',
-                       'pre_test_setup',
-                       'execute_test',
-                       'cleanup']:
+        # A test can go on from its setup to its pre-test setup without
+        # waiting for the slower ones.  Execution starts on all the tests
+        # together, and cleanup waits for all of them to finish so that it
+        # doesn't load the storage while others are still being measured.
+        for methods in [('setup_environment', 'pre_test_setup'),
+                        ('execute_test',),
+                        ('cleanup',)]:
             try:
-                lockobj = threading.Lock()
-                self._perform_ops(method=method, lock=lockobj)
+                self._perform_ops(methods=methods)
             except Exception as err:
-                log.exception('Exception while performing:%s', method)
+                log.exception('Exception while performing:%s',
+                              ', '.join(methods))
                 raise
         return self.results
 
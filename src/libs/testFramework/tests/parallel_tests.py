@@ -6,7 +6,6 @@ import logging
 import time
 from src.libs.testFramework import classicTest
 
-logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('SerialTest')
 
 
@@ -51,8 +50,14 @@ class ParallelTest(classicTest.TestInstance):
         """
         log.info("cleanup")
 
-test1 = ParallelTest(sleep=10)
-test2 = ParallelTest()
 
-operate = classicTest.PerformParallelOperations(test_instances=[test1, test2])
-operate.perform_all_operations()
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    test1 = ParallelTest(sleep=10)
+    test2 = ParallelTest()
+
+    operate = classicTest.PerformParallelOperations(
+        test_instances=[test1, test2])
+    operate.perform_all_operations()
+    operate.close()
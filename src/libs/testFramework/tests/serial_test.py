@@ -6,7 +6,6 @@ import logging
 
 from src.libs.testFramework import classicTest
 
-logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('SerialTest')
 
 
@@ -43,5 +42,9 @@ class SerialTest(classicTest.TestInstance):
         """
         log.info("cleanup")
 
-test = SerialTest(virtual_instance=None)
-test.perform_all_operations()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    test = SerialTest(virtual_instance=None)
+    test.perform_all_operations()
@@ -1,24 +1,16 @@
-import threading
-import logging
+import random
 
-log = logging.getLogger(__name__)
 
-
-class ThreadWithError(threading.Thread):
+def backoff_delays(initial_sec, max_sec, jitter=0.25):
     """
-    Quick extended thread class to help us capture/report errors
+    Generator of exponentially growing sleep times for polling loops,
+    doubling from initial_sec up to max_sec with some random jitter added
+    so that concurrent pollers don't stay in lock step.
+    :param initial_sec: first delay in seconds
+    :param max_sec: cap for the delay in seconds
+    :param jitter: fraction of the delay that may be randomly added
     """
-    def __init__(self, *args, **kwargs):
-        super(self.__class__, self).__init__(*args, **kwargs)
-        self.error = False
-
-    def run(self):
-        self.error = False
-        try:
-            super(self.__class__, self).run()
-        except Exception as err:
-            log.exception("Hit error in thread:%s", err.message)
-            self.error = True
-
-    def has_error(self):
-        return self.error
+    delay = initial_sec
+    while True:
+        yield delay + random.uniform(0, delay * jitter)
+        delay = min(delay * 2, max_sec)
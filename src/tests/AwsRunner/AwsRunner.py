@@ -4,19 +4,64 @@ Please refer to top-level LICENSE file for copyright information
 """
 
 import argparse
+import itertools
 import json
 import logging
 import os
-import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import paramiko
+
+from src.libs.cloudInfra import AwsSession
 from src.libs.cloudInfra import CloudProvider
 from src.libs.cloudInfra import CloudStorage
 from src.libs.testFramework import classicTest
 
-
-logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('AwsRunner')
 
+# Markers echoed between the phases of the file operation script.
+_PHASE_MARKERS = {'create': '###CREATE###',
+                  'read': '###READ###',
+                  'delete': '###DELETE###'}
+_PHASE_ERROR = '###ERROR###'
+
+# Packages needed to run a prebuilt s3fs binary, plus fio.  s3fs is built
+# against libcurl with OpenSSL, its dev package pulls in the right runtime
+# library for the release.
+_S3FS_RUNTIME_PKGS = 'fuse libcurl4-openssl-dev libxml2 mime-support fio'
+
+# More uploads in flight and a larger stat cache than the s3fs defaults.
+# File contents are not cached, so that reads go to S3.
+_S3FS_MOUNT_OPTIONS = ' -o parallel_count=30 -o multipart_size=52' \
+                      ' -o max_stat_cache_size=100000'
+
+# Local cache of the file contents, in RAM, used when local_cache is set,
+# along with letting the kernel keep file pages cached across opens.  s3fs
+# wants room for parallel_count parts of multipart_size MB on top of
+# ensure_diskfree in the cache directory, and /dev/shm only gets half the
+# RAM, so the parts are kept to the minimum size.
+_S3FS_LOCAL_CACHE_DIR = '/dev/shm/s3cache'
+_S3FS_LOCAL_CACHE_PARALLEL_COUNT = 5
+_S3FS_LOCAL_CACHE_MULTIPART_SIZE_MB = 5
+_S3FS_LOCAL_CACHE_OPTIONS = \
+    ' -o parallel_count=' + str(_S3FS_LOCAL_CACHE_PARALLEL_COUNT) + \
+    ' -o multipart_size=' + str(_S3FS_LOCAL_CACHE_MULTIPART_SIZE_MB) + \
+    ' -o max_stat_cache_size=100000 -o kernel_cache' + \
+    ' -o use_cache=' + _S3FS_LOCAL_CACHE_DIR
+
+_S3FS_BUILD_TIMEOUT_SEC = 1500
+
+# Number of times the file operation script is run when the SSH connection
+# drops under it.
+_EXECUTE_ATTEMPTS = 2
+
+# Number of files worked on at the same time by each test, every operation
+# on the s3fs mount is a round trip to S3 so they are latency bound.
+DEFAULT_PARALLELISM = 32
+
 
 class Test(classicTest.TestInstance):
     """
@@ -28,7 +73,14 @@ class Test(classicTest.TestInstance):
                  bucket_name,
                  bucket_folder='/mnt/bucket',
                  aws_key=None,
-                 aws_sec_key=None):
+                 aws_sec_key=None,
+                 io_tool='dd',
+                 s3fs_cache=None,
+                 parallelism=DEFAULT_PARALLELISM,
+                 prebuilt_s3fs_url=None,
+                 use_s3fs=True,
+                 local_cache=False,
+                 fio_ioengine='psync'):
         super(self.__class__, self).__init__(virtual_instance=virtual_instance)
 
         self._s3_fs_package = 's3fs-fuse'
@@ -38,8 +90,22 @@ class Test(classicTest.TestInstance):
         self._aws_key = aws_key
         self._aws_sec_key = aws_sec_key
         self._s3_bucket_name = bucket_name
-        self._unique_dir = \
-            self._bucket_folder + '/test_' + self._vinstance.get_instance_id()
+        self._io_tool = io_tool
+        self._s3fs_cache = s3fs_cache
+        self._parallelism = parallelism
+        self._prebuilt_s3fs_url = prebuilt_s3fs_url
+        self._use_s3fs = use_s3fs
+        self._local_cache = local_cache
+        self._fio_ioengine = fio_ioengine
+        self._instance_id = self._vinstance.get_instance_id()
+        self._unique_dir = self._bucket_folder + '/test_' + self._instance_id
+        # Where the files go when they are copied with the AWS CLI instead
+        # of going through the s3fs mount.
+        self._unique_prefix = 's3://' + self._s3_bucket_name + '/test_' + \
+            self._instance_id
+        # Everything the scripts depend on is fixed by now, build them once.
+        self._scripts = dict((file_type, self._build_script(file_type))
+                             for file_type in ('zero', 'random'))
 
     def setup_environment(self):
         """
@@ -51,36 +117,128 @@ class Test(classicTest.TestInstance):
         # Make sure the OS is responding
         self._vinstance.wait_for_gos_to_respond()
 
-        # install OS packages.
-        apt_get_cmd = 'DEBIAN_FRONTEND=noninteractive sudo apt-get -y '
-
-        pkg_list = 'build-essential libfuse-dev' \
-                   ' libxml2-dev mime-support automake autotools-dev' \
-                   ' g++ git libcurl4-gnutls-dev libssl-dev libxml2-dev' \
-                   ' make pkg-config'
-        self._vinstance.run_command_on_gos(apt_get_cmd + 'update', 300)
-        self._vinstance.run_command_on_gos(apt_get_cmd + 'install ' +
-                                           pkg_list, 300)
-
-        # Install s3fs
-        self._vinstance.run_command_on_gos('git clone %s' % self._s3_fs_server)
-        self._vinstance.run_command_on_gos('cd %s; ./autogen.sh' %
-                                           self._s3_fs_package, 120)
-        self._vinstance.run_command_on_gos('cd ' + self._s3_fs_package +
-                                           '; ./configure --prefix=/usr', 120)
-        self._vinstance.run_command_on_gos('cd ' + self._s3_fs_package +
-                                           '; make', 300)
-        self._vinstance.run_command_on_gos('cd ' + self._s3_fs_package +
-                                           '; sudo make install', 300)
+        if not self._use_s3fs:
+            try:
+                self._vinstance.run_command_on_gos('which aws', 120)
+            except RuntimeError:
+                self._vinstance.run_command_on_gos(
+                    _apt_get_install('awscli'), 600, capture_output=False)
+            # Give the CLI the credentials once, rather than on the command
+            # line of every command.
+            self._vinstance.run_command_on_gos('mkdir -p -m 700 .aws')
+            self._vinstance.write_file_on_gos(
+                '.aws/credentials',
+                '[default]\naws_access_key_id = ' + self._aws_key +
+                '\naws_secret_access_key = ' + self._aws_sec_key + '\n')
+            return
+
+        # Images baked from a previous run (see --saveami) already have
+        # everything installed.
+        try:
+            self._vinstance.run_command_on_gos('which s3fs fio', 120)
+            log.info('Test programs already installed, skipping install')
+        except RuntimeError:
+            self._install_programs()
+
+        # Create the bucket directory (and cache) for later mounting
+        folders = [self._bucket_folder]
+        if self._local_cache:
+            folders.append(_S3FS_LOCAL_CACHE_DIR)
+        self._vinstance.run_commands_on_gos(
+            ['sudo mkdir -p ' + ' '.join(folders),
+             'sudo chmod 777 ' + ' '.join(folders)])
+
+    def _install_programs(self):
+        """
+        The _install_programs method will install the OS packages and s3fs,
+        taking the s3fs binary from the prebuilt tarball if one was given,
+        or from the s3fs_cache when another test has already built it.
+        :return:
+        """
+        if self._prebuilt_s3fs_url and self._install_prebuilt_s3fs():
+            return
+        if self._s3fs_cache is None:
+            self._build_s3fs()
+        elif self._s3fs_cache.claim_build():
+            try:
+                self._build_s3fs()
+            except Exception:
+                self._s3fs_cache.set_published(False)
+                raise
+            try:
+                # curl doesn't fail on a redirect, only count a 200 as
+                # published.
+                status = self._vinstance.run_command_on_gos(
+                    "curl -sSf -o /dev/null -w '%%{http_code}'"
+                    " -T /usr/bin/s3fs '%s'" %
+                    self._s3fs_cache.get_upload_url(), 300)
+                published = status.strip() == '200'
+                if not published:
+                    log.error('Publishing the s3fs binary got HTTP %s',
+                              status.strip())
+            except Exception:
+                log.exception('Error while publishing the s3fs binary')
+                published = False
+            self._s3fs_cache.set_published(published)
+        else:
+            self._vinstance.run_command_on_gos(
+                _apt_get_install(_S3FS_RUNTIME_PKGS), 600,
+                capture_output=False)
+            url = self._s3fs_cache.get_download_url(_S3FS_BUILD_TIMEOUT_SEC)
+            if url is None:
+                log.info('No shared s3fs binary, building it')
+                self._build_s3fs()
+            else:
+                try:
+                    self._vinstance.run_command_on_gos(
+                        "curl -sSf -o /tmp/s3fs '%s'"
+                        " && sudo install -m 755 /tmp/s3fs /usr/bin/s3fs"
+                        " && /usr/bin/s3fs -h" % url, 300)
+                except RuntimeError:
+                    log.warning('Could not use the shared s3fs, building it')
+                    self._build_s3fs()
 
         # Check that s3fs is responsive
         self._vinstance.run_command_on_gos('/usr/bin/s3fs -h', 120)
 
-        # Create the bucket directory for later mounting
-        self._vinstance.run_command_on_gos('sudo mkdir -p ' +
-                                           self._bucket_folder)
-        self._vinstance.run_command_on_gos('sudo chmod 777 ' +
-                                           self._bucket_folder)
+    def _install_prebuilt_s3fs(self):
+        """
+        The _install_prebuilt_s3fs method will install the runtime packages
+        and extract the prebuilt s3fs tarball over /.  A {release} in the
+        url is replaced by the OS release of the instance, so that one
+        tarball can be kept per release.
+        :return: True if s3fs is installed and responsive, False otherwise
+        """
+        url = self._prebuilt_s3fs_url.replace('{release}',
+                                              '$(lsb_release -rs)')
+        try:
+            self._vinstance.run_command_on_gos(
+                _apt_get_install(_S3FS_RUNTIME_PKGS) +
+                ' && curl -sSfL "%s" | sudo tar xz -C /' % url +
+                ' && /usr/bin/s3fs -h', 900, capture_output=False)
+        except RuntimeError:
+            log.warning('Could not use the prebuilt s3fs, building it')
+            return False
+        return True
+
+    def _build_s3fs(self):
+        """
+        The _build_s3fs method will install the build dependencies and build
+        s3fs from source, all in a single command.
+        :return:
+        """
+        pkg_list = 'build-essential libfuse-dev' \
+                   ' libxml2-dev mime-support automake autotools-dev' \
+                   ' g++ git libcurl4-openssl-dev libssl-dev libxml2-dev' \
+                   ' make pkg-config fio'
+        self._vinstance.run_command_on_gos(
+            _apt_get_install(pkg_list) +
+            ' && git clone ' + self._s3_fs_server +
+            ' && cd ' + self._s3_fs_package +
+            ' && ./autogen.sh' +
+            ' && ./configure --prefix=/usr' +
+            ' && make -j$(nproc)' +
+            ' && sudo make install', 1440, capture_output=False)
 
     def pre_test_setup(self):
         """
@@ -89,17 +247,41 @@ class Test(classicTest.TestInstance):
         :return:
         """
         super(self.__class__, self).pre_test_setup()
+        if not self._use_s3fs:
+            return
 
-        # Mount the bucket
-        self._vinstance.run_command_on_gos(
-            'AWSACCESSKEYID=' + self._aws_key +
-            ' AWSSECRETACCESSKEY=' + self._aws_sec_key +
-            ' s3fs ' + self._s3_bucket_name + ': ' +
-            self._bucket_folder)
-        # Create a subdir for the files.
-        self._vinstance.run_command_on_gos(
-            'mkdir -p ' + self._bucket_folder + '/test_' +
-            self._vinstance.get_instance_id())
+        if self._local_cache:
+            mount_options = self._get_local_cache_options()
+        else:
+            mount_options = _S3FS_MOUNT_OPTIONS
+
+        # Mount the bucket and create a subdir for the files.
+        self._vinstance.run_commands_on_gos(
+            ['AWSACCESSKEYID=' + self._aws_key +
+             ' AWSSECRETACCESSKEY=' + self._aws_sec_key +
+             ' s3fs ' + self._s3_bucket_name + ': ' +
+             self._bucket_folder + mount_options,
+             'mkdir -p ' + self._unique_dir])
+
+    def _get_local_cache_options(self):
+        """
+        The _get_local_cache_options method will build the s3fs mount
+        options for the local cache, keeping a quarter of the space free
+        in the cache directory for the rest of the system.
+        :return: mount options
+        """
+        output = self._vinstance.run_command_on_gos(
+            "df -Pm " + _S3FS_LOCAL_CACHE_DIR + " | awk 'NR==2 {print $4}'")
+        free_mb = int(output.strip())
+        diskfree_mb = free_mb // 4
+        needed_mb = _S3FS_LOCAL_CACHE_PARALLEL_COUNT * \
+            _S3FS_LOCAL_CACHE_MULTIPART_SIZE_MB + diskfree_mb
+        if free_mb < needed_mb:
+            log.error('Only %d MB free in %s, s3fs needs %d MB',
+                      free_mb, _S3FS_LOCAL_CACHE_DIR, needed_mb)
+            raise RuntimeError('Not enough space for the local cache')
+        return _S3FS_LOCAL_CACHE_OPTIONS + \
+            ' -o ensure_diskfree=' + str(diskfree_mb)
 
     def execute_test(self, file_type='zero'):
         """
@@ -109,47 +291,171 @@ class Test(classicTest.TestInstance):
         :return:
         """
         super(self.__class__, self).execute_test()
-        if file_type == 'zero':
-            create_command = 'time for i in `seq 1 100`;' \
-                            ' do dd if=/dev/zero of=' + self._unique_dir +\
-                            '/test$i bs=1024 count=4; done'
-        elif file_type == 'random':
-            create_command = 'time for i in `seq 1 100`;' \
-                            ' do dd if=/dev/urandom of=' + self._unique_dir +\
-                            '/test$i bs=1024 count=4; done'
-        else:
+        if file_type not in self._scripts:
             log.error('Unknown file type specified, expected zero/random')
             raise Exception()
-        read_command = 'time for i in `seq 1 100`; do cat ' +\
-                       self._unique_dir + '/test$i >> /dev/null; done'
-        delete_command = 'time for i in `seq 1 100`; do rm ' +\
-                         self._unique_dir + '/test$i; done'
-        try:
-            create_output = self._vinstance.run_command_on_gos(create_command,
-                                                               600)
-        except:
-            log.error('Error while running file create command')
-            create_output = ""
-        try:
-            read_output = self._vinstance.run_command_on_gos(read_command,
-                                                             600)
-        except Exception:
-            log.error('Error while running file read command')
-            read_output = ""
-        try:
-            delete_output = self._vinstance.run_command_on_gos(delete_command,
-                                                               600)
-        except Exception:
-            delete_output = ""
-            log.error('Error while running file delete command')
-        return self.parse_output(create_output, read_output, delete_output)
+        script = self._scripts[file_type]
+
+        output = ""
+        for attempt in range(_EXECUTE_ATTEMPTS):
+            try:
+                output = self._vinstance.run_command_on_gos(script, 1800)
+                break
+            except (paramiko.SSHException, EOFError, socket.error):
+                # A dropped connection is worth another go, rather than
+                # losing the whole run to it.  socket.error covers timeouts
+                # and failed reconnects too.
+                log.warning('Lost the connection while running file'
+                            ' operation commands', exc_info=True)
+                if attempt + 1 < _EXECUTE_ATTEMPTS:
+                    time.sleep(2 ** attempt)
+            except RuntimeError:
+                # The script ran but failed, its output is already logged.
+                break
+            except Exception:
+                # Report this test's phases as failed instead of aborting
+                # the phase for every other test.
+                log.exception('Unexpected error while running file'
+                              ' operation commands')
+                break
+        if not output:
+            log.error('Error while running file operation commands')
+        sections = _split_on_markers(output)
+        return self.parse_output(sections['create'],
+                                 sections['read'],
+                                 sections['delete'])
+
+    def _build_script(self, file_type):
+        """
+        The _build_script method will build the script running all three
+        file operation phases in a single SSH invocation, tagging each
+        phase's output so it can be split apart locally.
+        :param file_type: file_type to use for the operation(zero/random)
+        :return: shell script
+        """
+        if self._io_tool == 'tar':
+            create_command, read_command, delete_command = \
+                self._get_tar_commands(file_type)
+        elif not self._use_s3fs:
+            create_command, read_command, delete_command = \
+                self._get_aws_cli_commands(file_type)
+        elif self._io_tool == 'dd':
+            create_command, read_command, delete_command = \
+                self._get_dd_commands(file_type)
+        elif self._io_tool == 'fio':
+            create_command, read_command, delete_command = \
+                self._get_fio_commands(file_type)
+        else:
+            log.error('Unknown io tool specified, expected dd/fio/tar')
+            raise Exception()
 
-    def _get_time_ms(self, minutes, seconds, millisec):
-        time_ms = 0
-        time_ms += int(minutes) * 60 * 1000
-        time_ms += int(seconds) * 1000
-        time_ms += int(millisec)
-        return time_ms
+        return '; '.join(
+            "echo '%s'; %s || echo '%s'" % (_PHASE_MARKERS[phase], command,
+                                            _PHASE_ERROR)
+            for phase, command in (('create', create_command),
+                                   ('read', read_command),
+                                   ('delete', delete_command)))
+
+    def _get_dd_commands(self, file_type):
+        """
+        The _get_dd_commands method will build the timed create, read and
+        delete commands, running dd/cat/rm once per file with up to
+        parallelism files in flight.
+        :param file_type: file_type to use for the operation(zero/random)
+        :return: tuple of create, read and delete commands
+        """
+        if file_type == 'zero':
+            source = '/dev/zero'
+        else:
+            source = '/dev/urandom'
+        xargs_cmd = 'time seq 1 100 | xargs -P ' + str(self._parallelism) + \
+                    ' -I{} '
+        create_command = xargs_cmd + 'dd if=' + source + ' of=' + \
+            self._unique_dir + '/test{} bs=1024 count=4'
+        read_command = xargs_cmd + 'cat ' + self._unique_dir + \
+            '/test{} >> /dev/null'
+        delete_command = xargs_cmd + 'rm ' + self._unique_dir + '/test{}'
+        return create_command, read_command, delete_command
+
+    def _get_aws_cli_commands(self, file_type):
+        """
+        The _get_aws_cli_commands method will build the timed create, read
+        and delete commands, copying each file to and from S3 with the AWS
+        CLI, up to parallelism files in flight, instead of going through
+        the s3fs mount.
+        :param file_type: file_type to use for the operation(zero/random)
+        :return: tuple of create, read and delete commands
+        """
+        if file_type == 'zero':
+            source = '/dev/zero'
+        else:
+            source = '/dev/urandom'
+        local_file = '/tmp/cloudrunner_testfile'
+        xargs_cmd = 'time seq 1 100 | xargs -P ' + str(self._parallelism) + \
+                    ' -I{} aws s3 '
+        create_command = 'dd if=' + source + ' of=' + local_file + \
+            ' bs=1024 count=4 && ' + xargs_cmd + 'cp --only-show-errors ' + \
+            local_file + ' ' + self._unique_prefix + '/test{}'
+        read_command = xargs_cmd + 'cp --only-show-errors ' + \
+            self._unique_prefix + '/test{} - >> /dev/null'
+        delete_command = xargs_cmd + 'rm --only-show-errors ' + \
+            self._unique_prefix + '/test{}'
+        return create_command, read_command, delete_command
+
+    def _get_tar_commands(self, file_type):
+        """
+        The _get_tar_commands method will build the timed create, read and
+        delete commands, storing the files as a single tar archive so that
+        they take one upload and one download instead of one per file.  The
+        files themselves are made locally, outside of the timing.
+        :param file_type: file_type to use for the operation(zero/random)
+        :return: tuple of create, read and delete commands
+        """
+        if file_type == 'zero':
+            source = '/dev/zero'
+        else:
+            source = '/dev/urandom'
+        local_dir = '/tmp/cloudrunner_batch'
+        make_files = 'rm -rf ' + local_dir + ' && mkdir ' + local_dir + \
+            ' && for i in `seq 1 100`; do dd if=' + source + ' of=' + \
+            local_dir + '/test$i bs=1024 count=4; done && '
+        tar_cmd = 'tar -cf - -C ' + local_dir + ' .'
+        if self._use_s3fs:
+            archive = self._unique_dir + '/batch.tar'
+            create_command = make_files + 'time ' + tar_cmd + ' > ' + archive
+            read_command = 'time tar -xOf ' + archive + ' >> /dev/null'
+            delete_command = 'time rm ' + archive
+        else:
+            archive = self._unique_prefix + '/batch.tar'
+            aws_cmd = 'aws s3 cp --only-show-errors '
+            create_command = make_files + 'time ' + tar_cmd + ' | ' + \
+                aws_cmd + '- ' + archive
+            read_command = 'time ' + aws_cmd + archive + \
+                ' - | tar -xOf - >> /dev/null'
+            delete_command = 'time aws s3 rm --only-show-errors ' + archive
+        return create_command, read_command, delete_command
+
+    def _get_fio_commands(self, file_type):
+        """
+        The _get_fio_commands method will build the timed create, read and
+        delete commands, letting a single fio process handle all the files
+        of a phase instead of forking once per file.
+        :param file_type: file_type to use for the operation(zero/random)
+        :return: tuple of create, read and delete commands
+        """
+        fio_cmd = 'fio --name=test --directory=' + self._unique_dir + \
+                  ' --bs=4k --filesize=4k --nrfiles=100 --openfiles=1' \
+                  ' --fallocate=none --output=/dev/null' \
+                  ' --ioengine=' + self._fio_ioengine
+        if self._fio_ioengine != 'psync':
+            # Only the asynchronous engines keep several IOs in flight.
+            fio_cmd += ' --iodepth=32'
+        if file_type == 'zero':
+            fio_cmd += ' --zero_buffers'
+        create_command = 'time ' + fio_cmd + ' --rw=write'
+        read_command = 'time ' + fio_cmd + ' --rw=read'
+        delete_command = 'time rm ' + self._unique_dir + '/test.*'
+        return create_command, read_command, delete_command
 
     def parse_output(self, create_output, read_output, delete_output):
         """
@@ -160,35 +466,26 @@ class Test(classicTest.TestInstance):
         :param delete_output: output from delete operations.
         :return: RunResult object
         """
-        run_result = RunResult(self._vinstance.get_instance_id)
+        run_result = RunResult(self._instance_id)
 
-        time_pattern = r'real\s+(\d+)m(\d+)\.(\d+)s'
-        match = re.search(time_pattern, create_output)
-        if match:
+        time_ms = _parse_real_line(create_output)
+        if time_ms is not None:
             run_result.set_file_create_status(True)
-            run_result.set_file_create_time_ms(
-                self._get_time_ms(match.group(1),
-                                  match.group(2),
-                                  match.group(3)))
+            run_result.set_file_create_time_ms(time_ms)
         else:
             run_result.set_file_create_status(False)
 
-        match = re.search(time_pattern, read_output)
-        if match:
+        time_ms = _parse_real_line(read_output)
+        if time_ms is not None:
             run_result.set_file_read_status(True)
-            run_result.set_file_read_time_ms(self._get_time_ms(match.group(1),
-                                                               match.group(2),
-                                                               match.group(3)))
+            run_result.set_file_read_time_ms(time_ms)
         else:
             run_result.set_file_read_status(False)
 
-        match = re.search(time_pattern, delete_output)
-        if match:
+        time_ms = _parse_real_line(delete_output)
+        if time_ms is not None:
             run_result.set_file_delete_status(True)
-            run_result.set_file_delete_time_ms(
-                self._get_time_ms(match.group(1),
-                                  match.group(2),
-                                  match.group(3)))
+            run_result.set_file_delete_time_ms(time_ms)
         else:
             run_result.set_file_delete_status(False)
         return run_result
@@ -199,62 +496,138 @@ class Test(classicTest.TestInstance):
         :return:
         """
         super(self.__class__, self).cleanup()
-        self._vinstance.run_command_on_gos('rm -rf ' +
-                                           self._bucket_folder + '/*')
-        self._vinstance.run_command_on_gos('sudo umount ' +
-                                           self._bucket_folder)
+        # Only remove this test's own files, the bucket is shared with the
+        # other tests and the s3fs cache.
+        if not self._use_s3fs:
+            # Don't leave the credentials behind, even if the rm fails.
+            self._vinstance.run_command_on_gos(
+                'aws s3 rm --recursive --only-show-errors ' +
+                self._unique_prefix +
+                '; status=$?; rm -f .aws/credentials; exit $status')
+            return
+        self._vinstance.run_commands_on_gos(
+            ['rm -rf ' + self._unique_dir,
+             'sudo umount ' + self._bucket_folder])
+
+
+class S3fsBinaryCache(object):
+    """
+    S3fsBinaryCache class lets the tests of a run share a single s3fs build.
+    The first test that needs s3fs builds it and uploads the binary to the
+    bucket, the other tests wait for it and download it instead of building
+    their own.  The transfers use presigned URLs, so the instances need no
+    AWS credentials or tools for them.
+    """
+    def __init__(self, storage, bucket_name, key='bin/s3fs'):
+        self._storage = storage
+        self._bucket_name = bucket_name
+        self._key = key
+        self._lock = threading.Lock()
+        self._build_claimed = False
+        self._published = False
+        self._done = threading.Event()
+
+    def claim_build(self):
+        """
+        The claim_build method will tell the caller whether it should build
+        and publish s3fs, which is only the case for the first caller and
+        only if the binary isn't in the bucket yet.
+        :return: True if the caller should build s3fs, False otherwise.
+        """
+        with self._lock:
+            if self._build_claimed:
+                return False
+            self._build_claimed = True
+            if self._storage.object_exists(self._bucket_name, self._key):
+                self.set_published(True)
+                return False
+            return True
+
+    def set_published(self, published):
+        """
+        The set_published method is called by the builder once it is done,
+        releasing the tests waiting for the binary.
+        :param published: True if the binary was uploaded.
+        :return:
+        """
+        self._published = published
+        self._done.set()
+
+    def get_upload_url(self):
+        return self._storage.get_object_url(self._bucket_name, self._key,
+                                            method='put')
+
+    def get_download_url(self, timeout_sec):
+        """
+        The get_download_url method will wait for the builder to finish.
+        :param timeout_sec: how long to wait for the builder.
+        :return: URL to download the binary from, None if there is none.
+        """
+        self._done.wait(timeout_sec)
+        if not self._published:
+            return None
+        return self._storage.get_object_url(self._bucket_name, self._key)
 
 
 class RunAverages(object):
     """
     RunAverages class to manages the averaged data for the tests being run.
     """
+    __slots__ = ('_average_create_time_ms',
+                 '_average_read_time_ms',
+                 '_average_delete_time_ms',
+                 '_run_id',
+                 '_total_create_pass',
+                 '_total_create_fail',
+                 '_total_create_time_ms',
+                 '_total_read_pass',
+                 '_total_read_fail',
+                 '_total_read_time_ms',
+                 '_total_delete_pass',
+                 '_total_delete_fail',
+                 '_total_delete_time_ms')
+
     def __init__(self, run_result_list, run_id):
-        self._total_create_pass = 0
-        self._total_create_fail = 0
-        self._total_create_time_ms = 0
         self._average_create_time_ms = 0
-        self._total_read_pass = 0
-        self._total_read_fail = 0
-        self._total_read_time_ms = 0
         self._average_read_time_ms = 0
-        self._total_delete_pass = 0
-        self._total_delete_fail = 0
         self._average_delete_time_ms = 0
-        self._total_delete_time_ms = 0
 
         self._run_id = run_id
-        for report in run_result_list:
-            if report.get_file_create_status():
-                self._total_create_pass += 1
-                self._total_create_time_ms += report.get_file_create_time_ms()
-            else:
-                self._total_create_fail += 1
-            if report.get_file_read_status():
-                self._total_read_pass += 1
-                self._total_read_time_ms += report.get_file_read_time_ms()
-            else:
-                self._total_read_fail += 1
-            if report.get_file_delete_status():
-                self._total_delete_pass += 1
-                self._total_delete_time_ms += report.get_file_delete_time_ms()
-            else:
-                self._total_delete_fail += 1
+        create_times = _passed_times(run_result_list,
+                                     RunResult.get_file_create_status,
+                                     RunResult.get_file_create_time_ms)
+        read_times = _passed_times(run_result_list,
+                                   RunResult.get_file_read_status,
+                                   RunResult.get_file_read_time_ms)
+        delete_times = _passed_times(run_result_list,
+                                     RunResult.get_file_delete_status,
+                                     RunResult.get_file_delete_time_ms)
+
+        self._total_create_pass = len(create_times)
+        self._total_create_fail = len(run_result_list) - len(create_times)
+        self._total_create_time_ms = sum(create_times)
+        self._total_read_pass = len(read_times)
+        self._total_read_fail = len(run_result_list) - len(read_times)
+        self._total_read_time_ms = sum(read_times)
+        self._total_delete_pass = len(delete_times)
+        self._total_delete_fail = len(run_result_list) - len(delete_times)
+        self._total_delete_time_ms = sum(delete_times)
+
         if self._total_create_pass == 0:
             self._average_create_time_ms = -1
         else:
             self._average_create_time_ms = \
-                self._total_create_time_ms / self._total_create_pass
+                self._total_create_time_ms // self._total_create_pass
         if self._total_read_pass == 0:
-            self._average_create_time_ms = -1
+            self._average_read_time_ms = -1
         else:
             self._average_read_time_ms = \
-                self._total_read_time_ms / self._total_read_pass
+                self._total_read_time_ms // self._total_read_pass
         if self._total_delete_pass == 0:
             self._average_delete_time_ms = -1
         else:
             self._average_delete_time_ms = \
-                self._total_delete_time_ms / self._total_delete_pass
+                self._total_delete_time_ms // self._total_delete_pass
 
     def get_avg_create_time_ms(self):
         return self._average_create_time_ms
@@ -273,6 +646,14 @@ class RunResult(object):
     """
     The RunResult class deals with the per-instance per-run data.
     """
+    __slots__ = ('_id',
+                 '_file_create_time_ms',
+                 '_file_create_status',
+                 '_file_read_time_ms',
+                 '_file_read_status',
+                 '_file_delete_time_ms',
+                 '_file_delete_status')
+
     def __init__(self, resultId):
         self._id = resultId
         self._file_create_time_ms = 0
@@ -322,134 +703,235 @@ class RunResult(object):
         return self._id
 
 
-# Quick global data structure for all threads to report into.
-test_per_run_results = []
+def _passed_times(run_result_list, status_getter, time_getter):
+    """
+    The _passed_times function will pick the times of the results whose
+    status is set, looping with map/compress rather than in Python code.
+    :param run_result_list: list of RunResult objects
+    :param status_getter: RunResult method returning a status
+    :param time_getter: RunResult method returning the matching time
+    :return: list of times in milliseconds
+    """
+    return list(itertools.compress(map(time_getter, run_result_list),
+                                   map(status_getter, run_result_list)))
 
 
-def report_results(list_of_results, outfile=None):
-    results = []
-    for run_result in list_of_results:
-        result = {}
-        result['RunId'] = str(run_result.get_run_id())
-        result['AvgCreateTimeMs'] = str(run_result.get_avg_create_time_ms())
-        result['AvgReadTimeMs'] = str(run_result.get_avg_read_time_ms())
-        result['AvgDelTimeMs'] = str(run_result.get_avg_delete_time_ms())
-        results.append(result)
-    log.info(json.dumps(results))
-    if outfile:
-        with open(outfile, 'w') as out_file:
-            out_file.write(json.dumps(results))
-            out_file.close()
+def _apt_get_install(packages):
+    """
+    The _apt_get_install function will build the command refreshing the
+    package lists and installing the given packages.
+    :param packages: space separated list of packages
+    :return: shell command
+    """
+    apt_get_cmd = 'DEBIAN_FRONTEND=noninteractive sudo apt-get -y '
+    return apt_get_cmd + 'update && ' + apt_get_cmd + 'install ' + packages
 
 
-def general_test_prep(test_object):
-    test_object.setup_environment()
+def _parse_real_line(output):
+    """
+    The _parse_real_line function will find the wall clock time reported by
+    the shell `time` keyword, a line like "real    1m2.345s".
+    :param output: output of a timed command
+    :return: wall clock time in milliseconds, None if not found.
+    """
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) != 2 or fields[0] != 'real':
+            continue
+        minutes, _, seconds = fields[1].partition('m')
+        seconds, _, millisec = seconds.rstrip('s').partition('.')
+        try:
+            return int(minutes) * 60000 + int(seconds) * 1000 + int(millisec)
+        except ValueError:
+            continue
+    return None
 
 
-def pre_test_setup(test_object):
-    test_object.pre_test_setup()
+def _split_on_markers(output):
+    """
+    The _split_on_markers function will split the output of the file
+    operation script into the output of each phase.
+    :param output: combined output of the script
+    :return: dict of phase name to output, empty if the phase failed.
+    """
+    markers = dict((marker, phase) for phase, marker in _PHASE_MARKERS.items())
+    sections = dict((phase, []) for phase in _PHASE_MARKERS)
+    phase = None
+    for line in output.splitlines():
+        if line.strip() in markers:
+            phase = markers[line.strip()]
+        elif phase is not None:
+            sections[phase].append(line)
+
+    split_output = {}
+    for phase, lines in sections.items():
+        if _PHASE_ERROR in lines:
+            log.error('Error while running file %s command', phase)
+            lines = []
+        split_output[phase] = '\n'.join(lines)
+    return split_output
 
 
-def run_test(test_object, lock_obj):
-    # result = test_object.execute_test('random')
-    result = test_object.execute_test()
-    with lock_obj:
-        test_per_run_results.append(result)
+def report_results(list_of_results, outfile=None):
+    # Numbers are kept as numbers in the JSON.
+    results = [{'RunId': run_result.get_run_id(),
+                'AvgCreateTimeMs': run_result.get_avg_create_time_ms(),
+                'AvgReadTimeMs': run_result.get_avg_read_time_ms(),
+                'AvgDelTimeMs': run_result.get_avg_delete_time_ms()}
+               for run_result in list_of_results]
+    payload = json.dumps(results)
+    log.info(payload)
+    if outfile:
+        with open(outfile, 'w') as out_file:
+            out_file.write(payload)
 
 
 def main():
     # Parse the command line for required parameters
     parser = argparse.ArgumentParser()
-    parser.add_argument('--clients', type=int,
+    parser.add_argument('--clients', type=int, required=True,
                         help='Number of instances to run')
-    parser.add_argument('--bucket', help='Name of the bucket to create')
-    parser.add_argument('--key', help='access key')
-    parser.add_argument('--secretkey', help='secret key')
-    parser.add_argument('--keypairname', help='key pair name'),
-    parser.add_argument('--keypairfile', help='path to .pem file created with'
-                                              'key pair')
-    parser.add_argument('--region', help='region where instance will run')
+    parser.add_argument('--bucket', required=True,
+                        help='Name of the bucket to create')
+    parser.add_argument('--key', required=True, help='access key')
+    parser.add_argument('--secretkey', required=True, help='secret key')
+    parser.add_argument('--keypairname', required=True, help='key pair name')
+    parser.add_argument('--keypairfile', required=True,
+                        help='path to .pem file created with key pair')
+    parser.add_argument('--region', required=True,
+                        help='region where instance will run')
     parser.add_argument('--outfile', help='file to output json results to')
+    parser.add_argument('--ami',
+                        default=CloudProvider.DEFAULT_EC2_INSTANCE_IMAGE,
+                        help='image to start the instances from')
+    parser.add_argument('--saveami',
+                        help='after the run, save the first instance as an'
+                             ' image with this name, for use with --ami')
+    parser.add_argument('--iotool', choices=['dd', 'fio', 'tar'],
+                        default='dd',
+                        help='tool used to create and read the test files,'
+                             ' tar stores them as a single archive')
+    parser.add_argument('--workers', type=int,
+                        default=classicTest.MAX_WORKERS,
+                        help='max number of instances to drive concurrently')
+    parser.add_argument('--parallelism', type=int,
+                        default=DEFAULT_PARALLELISM,
+                        help='number of files each instance works on at the'
+                             ' same time (dd and --no-s3fs)')
+    parser.add_argument('--prebuilt-s3fs-url',
+                        help='url of a tar.gz holding usr/bin/s3fs to install'
+                             ' instead of building it, {release} is replaced'
+                             ' by the OS release')
+    parser.add_argument('--no-s3fs', dest='use_s3fs', action='store_false',
+                        help='copy the files with the AWS CLI instead of'
+                             ' through an s3fs mount, measuring S3 rather'
+                             ' than s3fs')
+    parser.add_argument('--fio-ioengine',
+                        choices=['psync', 'libaio', 'io_uring'],
+                        help='fio I/O engine (default psync), io_uring needs'
+                             ' a 5.1+ kernel')
+    parser.add_argument('--local-cache', action='store_true',
+                        help='let s3fs cache the file contents in RAM, reads'
+                             ' then measure the cache rather than S3')
+    parser.add_argument('--keep-bucket', action='store_true',
+                        help='leave the bucket and its contents in place'
+                             ' after the run')
     args = parser.parse_args()
 
-    if args.clients <= 0:
-        log.error('Error, number of clients must be > 0')
-        raise Exception("Invalid number of clients")
-
-    if args.bucket is None:
-        log.error('Bucket not specified')
-        raise Exception("Bucket not specified")
-
-    # Check that the required credentials are found by boto
-    if args.region is None:
-        log.warn('Region not specified, using default')
-        raise Exception("Region name not specified")
-    if args.key is None:
-        log.error('Error, access key not specified')
-        raise Exception("access key not specified")
-    if args.secretkey is None:
-        log.error('Error, secret key not specified')
-        raise Exception("secret key not specified")
-
-    if args.keypairname is None:
-        log.error('Error, keypair name not specified')
-        raise Exception("keypair not specified")
-
-    if args.keypairfile is None:
-        log.error('Error, keypair file path not specified')
-        raise Exception("keypair file not specified")
+    # Reject bad invocations before anything is started in the cloud.
+    for name in ('clients', 'workers', 'parallelism'):
+        if getattr(args, name) <= 0:
+            parser.error('--%s must be > 0' % name)
+    if not args.use_s3fs and args.iotool == 'fio':
+        parser.error('--no-s3fs can only be used with --iotool dd or tar')
+    if not args.use_s3fs and args.local_cache:
+        parser.error('--local-cache needs s3fs')
+    if not args.use_s3fs and args.saveami:
+        # The instances hold the AWS credentials in this mode.
+        parser.error('--saveami can not be used with --no-s3fs')
+    if args.fio_ioengine is not None and args.iotool != 'fio':
+        parser.error('--fio-ioengine can only be used with --iotool fio')
     if not os.path.isfile(args.keypairfile):
-        raise Exception("keypair file not found:" + args.keypairfile)
+        parser.error('keypair file not found: ' + args.keypairfile)
+
+    # One session for all the AWS clients, so credentials are resolved once.
+    session = AwsSession.create_session(aws_key=args.key,
+                                        aws_secret_key=args.secretkey,
+                                        region=args.region)
 
     # Setup cloud provider connection (AWS)
     cloud_provider = CloudProvider.CloudProviderAWS(
+                        ec2_instance_image=args.ami,
                         ec2_region=args.region,
-                        ec2_aws_key=args.key,
-                        ec2_aws_secret_key=args.secretkey,
                         ec2_key_pair_name=args.keypairname,
-                        ec2_key_pair_file_path=args.keypairfile)
+                        ec2_key_pair_file_path=args.keypairfile,
+                        session=session,
+                        max_pool_connections=args.clients)
     cloud_provider.connect()
 
     # Storage stuff.
-    storage = CloudStorage.VirtualStorageS3(aws_key=args.key,
-                                            aws_secret_key=args.secretkey)
+    storage = CloudStorage.VirtualStorageS3(session=session,
+                                            max_pool_connections=args.clients)
     storage.connect()
 
+    # Reuse the bucket if it is already there, a deleted bucket's name can
+    # stay unavailable for a while.
     if storage.bucket_exists(args.bucket):
         storage.erase_bucket(args.bucket)
-        storage.delete_bucket(args.bucket)
-
-    storage.create_bucket(args.bucket)
+    else:
+        storage.create_bucket(args.bucket)
 
     # Setup all the instances in parallel
     virtual_instances = cloud_provider.create_instances(args.clients)
-    test_object_list = []
     test_run_averages = []
 
+    # Worker threads are kept for every phase of the run.
+    pool = ThreadPoolExecutor(max_workers=min(args.clients, args.workers))
     try:
         # Create all possible instances for this test,
         # and prepare as much as possible
         # before tests will begin.
-        for vinstance in virtual_instances:
-            test_object_list.append(Test(vinstance, args.bucket,
-                                    '/mnt/bucket', args.key, args.secretkey))
+        s3fs_cache = S3fsBinaryCache(storage, args.bucket)
+        test_object_list = [Test(vinstance, args.bucket, '/mnt/bucket',
+                                 args.key, args.secretkey,
+                                 io_tool=args.iotool, s3fs_cache=s3fs_cache,
+                                 parallelism=args.parallelism,
+                                 prebuilt_s3fs_url=args.prebuilt_s3fs_url,
+                                 use_s3fs=args.use_s3fs,
+                                 local_cache=args.local_cache,
+                                 fio_ioengine=args.fio_ioengine or 'psync')
+                            for vinstance in virtual_instances]
 
         # Run the tests, each step in parallel
         parallel_ops = classicTest.PerformParallelOperations(
-            test_instances=test_object_list)
+            test_instances=test_object_list, max_workers=args.workers,
+            executor=pool)
         parallel_ops.perform_all_operations()
 
-        # Calc averages from the run data
-        test_run_averages.append(RunAverages(
-            parallel_ops.get_execute_test_results(), 1))
+        # Calc averages from the run data, there is a single run.
+        test_run_averages = [RunAverages(
+            parallel_ops.get_execute_test_results(), 1)]
 
     except Exception:
         log.exception('Error while attempting to run test,'
                       ' attempting to clean up')
+    finally:
+        pool.shutdown(wait=False)
+
+    if args.saveami:
+        try:
+            image_id = cloud_provider.create_image(virtual_instances[0],
+                                                   args.saveami)
+            log.info('Saved image %s, pass --ami %s to reuse it',
+                     image_id, image_id)
+        except Exception:
+            log.exception('Error while saving image')
 
     # Cleanup the testbed
     cloud_provider.destroy_all_instances()
-    storage.delete_bucket(args.bucket)
+    if not args.keep_bucket:
+        storage.erase_bucket(args.bucket)
+        storage.delete_bucket(args.bucket)
 
     # Output a report of the test runs.
     if len(test_run_averages) >= 1:
@@ -458,4 +940,5 @@ def main():
         log.error("No results to report")
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     main()